@@ -8,65 +8,243 @@ from __future__ import print_function
 import mmap
 import collections
 import hashlib
+import io
 import json
 import os
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 
+# optional backends, resolved once at import time
+try:
+   import orjson
+except ImportError:
+   orjson = None
 
-_PYHASH_ALGORITHMS = ['city_128', 'city_64', 'fnv1_32', 'fnv1_64', 'fnv1a_32', 'fnv1a_64', 'logging', 'lookup3', 'lookup3_big', 'lookup3_little', 'murmur1_32', 'murmur1_aligned_32', 'murmur2_32', 'murmur2_aligned_32', 'murmur2_neutral_32', 'murmur2_x64_64a', 'murmur2_x86_64b', 'murmur2a_32', 'murmur3_32', 'murmur3_x64_128', 'murmur3_x86_128', 'spooky_128', 'spooky_32', 'spooky_64', 'super_fast_hash']
-_XXHASH_ALGORITHMS = ['xxh32', 'xxh64']
-_HASHLIB_ALGORITHMS = list(hashlib.algorithms_available)
-_WRAPPED_ALGORITHMS = _PYHASH_ALGORITHMS + ["mmh3"]
-ALGORITHMS = _PYHASH_ALGORITHMS + _XXHASH_ALGORITHMS + _HASHLIB_ALGORITHMS + ["mmh3"]
+try:
+   import xxhash
+except ImportError:
+   xxhash = None
+
+try:
+   import mmh3
+except ImportError:
+   mmh3 = None
 
-_HASHOBJ = None
+try:
+   import pyhash
+except ImportError:
+   pyhash = None
 
+
+_PYHASH_ALGORITHMS = ['city_128', 'city_64', 'fnv1_32', 'fnv1_64', 'fnv1a_32', 'fnv1a_64', 'logging', 'lookup3', 'lookup3_big', 'lookup3_little', 'murmur1_32', 'murmur1_aligned_32', 'murmur2_32', 'murmur2_aligned_32', 'murmur2_neutral_32', 'murmur2_x64_64a', 'murmur2_x86_64b', 'murmur2a_32', 'murmur3_32', 'murmur3_x64_128', 'murmur3_x86_128', 'spooky_128', 'spooky_32', 'spooky_64', 'super_fast_hash']
+_XXHASH_ALGORITHMS = ['xxh32', 'xxh64', 'xxh3_64', 'xxh3_128']
+# served straight from a whole-file buffer, see FileVersion._buildMapped
+_XXH3_ALGORITHMS = ['xxh3_64', 'xxh3_128']
+_NUMBA_ALGORITHMS = ['numba_fnv1a_64']
+_MAPPED_ALGORITHMS = _XXH3_ALGORITHMS + _NUMBA_ALGORITHMS
+_HASHLIB_ALGORITHMS = list(hashlib.algorithms_available)
+_WRAPPED_ALGORITHMS = _PYHASH_ALGORITHMS + _NUMBA_ALGORITHMS + ["mmh3"]
+ALGORITHMS = _PYHASH_ALGORITHMS + _XXHASH_ALGORITHMS + _NUMBA_ALGORITHMS + _HASHLIB_ALGORITHMS + ["mmh3"]
+
+# xxh3 is a non-cryptographic hash, fine for change detection and far faster
+# than md5; sha256 (hardware accelerated on most current CPUs) otherwise.
+DEFAULT_ALGORITHM = 'xxh3_64' if xxhash is not None else 'sha256'
+
+# Revision file layout. Files without a "formatVersion" are 1, whose table
+# version hashed every line of every file instead of the per-file digests.
+_FORMAT_VERSION = 2
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_FNV64_PRIME = 0x100000001b3
+_FNV64_OFFSET = 0xcbf29ce484222325
+
+# Fixed-width hex for the int-returning backends, at the backend's own digest
+# width in bits. Signed results (mmh3) are taken as unsigned.
+def _hexInt(bits, value):
+   return "%0*x" % (bits >> 2, value & ((1 << bits) - 1))
+
+# Digest width of a pyhash algorithm, from its name where it carries one.
+# lookup3* and super_fast_hash are 32-bit; 'logging' is taken as 64-bit so a
+# wider-than-32 result is never cut short.
+def _pyhashBits(algorithm):
+   if "_128" in algorithm:
+      return 128
+   if "_64" in algorithm or algorithm == "logging":
+      return 64
+   return 32
+
+# Returns (fnv1aBytes, fnv1aLineHashes) for the numba algorithm, compiling its
+# kernels on first use, or None when numba or numpy is not installed. numba is
+# slow to import, so neither is loaded before that.
+@lru_cache(maxsize=None)
+def _numbaKernels():
+   try:
+      import numba
+      import numpy
+   except ImportError:
+      return None
+
+   @numba.njit(cache=True)
+   def fnv1a(buf):
+      h = numpy.uint64(_FNV64_OFFSET)
+      for i in range(buf.size):
+         h = (h ^ numpy.uint64(buf[i])) * numpy.uint64(_FNV64_PRIME)
+      return h
+
+   @numba.njit(cache=True)
+   def fnv1aLines(buf):
+      # FNV-1a of every line (trailing newline included) in a uint8 buffer
+      n = buf.size
+      count = 0
+      for i in range(n):
+         if buf[i] == 10:
+            count += 1
+      if n and buf[n - 1] != 10:
+         count += 1
+
+      hashes = numpy.empty(count, numpy.uint64)
+      h = numpy.uint64(_FNV64_OFFSET)
+      idx = 0
+      for i in range(n):
+         c = buf[i]
+         h = (h ^ numpy.uint64(c)) * numpy.uint64(_FNV64_PRIME)
+         if c == 10:
+            hashes[idx] = h
+            idx += 1
+            h = numpy.uint64(_FNV64_OFFSET)
+      if idx < count:
+         hashes[idx] = h
+      return hashes
+
+   def fnv1aBytes(payload):
+      return int(fnv1a(numpy.frombuffer(payload, numpy.uint8)))
+
+   def fnv1aLineHashes(buf):
+      hashes = fnv1aLines(numpy.frombuffer(buf, numpy.uint8))
+      return {_hexInt(64, theHash): lineno for lineno, theHash in enumerate(hashes.tolist(), 1)}
+
+   return fnv1aBytes, fnv1aLineHashes
+
+# Files at least this large are mapped instead of read into memory
+_MMAP_THRESHOLD = 1 << 20
+
+# Contents of a file opened in binary mode, from a single read -- or a mapping
+# for large files, which the caller must close.
+def _readBuffer(inFile):
+   if os.fstat(inFile.fileno()).st_size >= _MMAP_THRESHOLD:
+      return mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+   return inFile.read()
+
+# Lines (endings included) of a buffer from _readBuffer, split on b"\n" only
+def _iterLines(buf):
+   if isinstance(buf, mmap.mmap):
+      buf.seek(0)
+      return iter(buf.readline, b"")
+   return io.BytesIO(buf)
+
+def _lineHashes(digest, buf):
+   return {digest(line): lineno for lineno, line in enumerate(_iterLines(buf), 1)}
+
+# Gives the one-shot pyhash/mmh3 functions a streaming interface: each payload
+# is hashed as it arrives and folded into a 64-bit accumulator (FNV-style
+# multiply/xor), so nothing is buffered until hexdigest().
 class HashWrapper(object):
+   __slots__ = ('hashObj', 'acc')
+
    def __init__(self, hashObj):
       self.hashObj = hashObj
-      self.soFar = []
+      self.acc = 0
 
    def update(self, payload):
-      self.soFar.append(payload)
+      self.acc = ((self.acc * _FNV64_PRIME) ^ (self.hashObj(payload) & _MASK64)) & _MASK64
    
    def hexdigest(self):
-      return hex(self.hashObj("".join(self.soFar)))[2:-1]
+      return _hexInt(64, self.acc)
+
+def _hexdigestOf(hashObj, payload):
+   return hashObj(payload).hexdigest()
+
+def _hexIntOf(hashObj, bits, payload):
+   return _hexInt(bits, hashObj(payload))
+
+def _requireModule(module, package, algorithm):
+   if module is None:
+      raise ImportError("Hash algorithm %s requires %s" % (repr(algorithm), package))
 
 class HashObject(object):
+   __slots__ = ('algorithm', 'hashObj', 'newEntrypoint', 'lineDigest', 'digestEntrypoint', 'hashLines', 'hasCheapDigest')
 
    def __init__(self, algorithm):
       self.algorithm = algorithm
+      # one-shot whole buffer digest and bulk line hashing, for mapped algorithms
+      self.digestEntrypoint = None
+      self.hashLines = None
       if algorithm in _HASHLIB_ALGORITHMS:
-         self.hashObj = eval("hashlib.%s" % algorithm)
-         self.newEntrypoint = partial(hashlib.new, algorithm)
+         # not every available algorithm has a named constructor (e.g. sha512_224)
+         self.hashObj = getattr(hashlib, algorithm, None) or partial(hashlib.new, algorithm)
+         self.newEntrypoint = self.hashObj
+         self.lineDigest = partial(_hexdigestOf, self.hashObj)
       elif algorithm in _XXHASH_ALGORITHMS:
-         import xxhash
-         self.hashObj = xxhash.xxh64
-         self.newEntrypoint = xxhash.xxh64
+         _requireModule(xxhash, "xxhash", algorithm)
+         self.hashObj = getattr(xxhash, algorithm)
+         self.newEntrypoint = self.hashObj
+         self.lineDigest = getattr(xxhash, "%s_hexdigest" % algorithm)
+         if algorithm in _XXH3_ALGORITHMS:
+            # one-shot C entrypoint, used to hash whole buffers without a streaming object
+            self.digestEntrypoint = self.lineDigest
+            self.hashLines = partial(_lineHashes, self.digestEntrypoint)
+      elif algorithm in _NUMBA_ALGORITHMS:
+         kernels = _numbaKernels()
+         _requireModule(kernels, "numba and numpy", algorithm)
+         fnv1aBytes, fnv1aLineHashes = kernels
+         self.hashObj = fnv1aBytes
+         self.newEntrypoint = partial(HashWrapper, self.hashObj)
+         self.lineDigest = partial(_hexIntOf, self.hashObj, 64)
+         self.digestEntrypoint = self.lineDigest
+         self.hashLines = fnv1aLineHashes
       elif algorithm == "mmh3":
-         import mmh3
+         _requireModule(mmh3, "mmh3", algorithm)
          self.hashObj = mmh3.hash
          self.newEntrypoint = partial(HashWrapper, self.hashObj)
+         self.lineDigest = partial(_hexIntOf, self.hashObj, 32)
       elif algorithm in _PYHASH_ALGORITHMS:
-         import pyhash
-         self.hashObj = eval("pyhash.%s()" % algorithm)
+         _requireModule(pyhash, "pyhash", algorithm)
+         self.hashObj = getattr(pyhash, algorithm)()
          self.newEntrypoint = partial(HashWrapper, self.hashObj)
+         self.lineDigest = partial(_hexIntOf, self.hashObj, _pyhashBits(algorithm))
       else:
          raise RuntimeError("Could not find hash algorithm %s" % repr(algorithm))
+
+      # Whether digest() is a single native call over the buffer. The wrapped
+      # backends can only digest line by line, as FileVersion._buildLines does.
+      self.hasCheapDigest = bool(self.digestEntrypoint) or algorithm not in _WRAPPED_ALGORITHMS
          
 
    def new(self):
       return self.newEntrypoint()
 
+   def digest(self, buf):
+      # The file version FileVersion.build records for a whole file buffer.
+      # Only available when hasCheapDigest is set.
+      if self.digestEntrypoint:
+         return self.digestEntrypoint(buf)
+      return self.hashObj(buf).hexdigest()
+
    def hash(self, payload):
-      if self.algorithm in _WRAPPED_ALGORITHMS:
-         return hex(self.hashObj(payload))[2:-1]
-      return self.hashObj(payload).hexdigest()
+      return self.lineDigest(payload)
+
+
+# HashObjects hold no per-run state, so one per algorithm is shared by every
+# table and file (and reused across files within a worker process).
+@lru_cache(maxsize=None)
+def _getHashObject(algorithm):
+   return HashObject(algorithm)
 
 
 class FileVersion(object):
+   __slots__ = ('hashAlgorithm', 'filePath', 'version', 'lineHash', 'processLineCallback', '_hasher')
 
-   def __init__(self, filePath, version=None, lineHash=None, hashAlgorithm=None, processLineCallback=None):
+   def __init__(self, filePath, version=None, lineHash=None, hashAlgorithm=None, processLineCallback=None, hasher=None):
       self.hashAlgorithm = hashAlgorithm
       self.filePath = filePath
       self.version = version
@@ -75,86 +253,222 @@ class FileVersion(object):
       # the affected line numbers will be listed.
       self.lineHash = lineHash if lineHash else {}
       self.processLineCallback = processLineCallback
+      # the HashObject, resolved lazily: tables read from disk may name an
+      # uninstalled algorithm
+      self._hasher = hasher
 
    def normalize(self):
       return {"filePath": self.filePath, 
               "version": self.version, 
               "lineHash": self.lineHash}
 
-   def build(self):
-      fileHashObj = _HASHOBJ.new()
-      with open(self.filePath, 'r') as inFile: 
-         lineno = 1
-         for line in inFile:
-            line = line.encode('utf-8')
-            fileHashObj.update(line)
-            self._processLine(line, lineno)
-            lineno += 1
+   def build(self, previousVersion=None):
+      if self._hasher is None:
+         self._hasher = _getHashObject(self.hashAlgorithm)
+
+      with open(self.filePath, 'rb') as inFile:
+         buf = _readBuffer(inFile)
+      try:
+         version = None
+         # When the file still matches the last run only the file digest is
+         # computed; lineHash is left empty since the caller already has it.
+         # Without a cheap digest this would walk the file twice, so those
+         # algorithms go straight to the single pass in _buildLines.
+         if previousVersion is not None and self._hasher.hasCheapDigest:
+            version = self._hasher.digest(buf)
+            if version == previousVersion:
+               self.version = version
+               return
+
+         if self.hashAlgorithm in _MAPPED_ALGORITHMS:
+            self._buildMapped(buf, version)
+         else:
+            self._buildLines(buf, version)
+      finally:
+         if isinstance(buf, mmap.mmap):
+            buf.close()
+
+   # version is the file digest when the caller already computed it
+   def _buildLines(self, buf, version=None):
+      # resolved once per algorithm, a C function where the backend has one
+      hashLine = self._hasher.lineDigest
+      setLine = self.lineHash.__setitem__
+      callback = self.processLineCallback
+      if version is not None:
+         for lineno, line in enumerate(_iterLines(buf), 1):
+            setLine(hashLine(line), lineno)
+            if callback:
+               callback(line)
+         self.version = version
+         return
+
+      fileHashObj = self._hasher.new()
+      update = fileHashObj.update
+      for lineno, line in enumerate(_iterLines(buf), 1):
+         update(line)
+         setLine(hashLine(line), lineno)
+         if callback:
+            callback(line)
       self.version = fileHashObj.hexdigest()
 
-   def _processLine(self, line, lineno):
-      theHash = _HASHOBJ.hash(line)
-      self.lineHash[theHash] = lineno
-      if self.processLineCallback:
-         self.processLineCallback(line)
+   def _buildMapped(self, buf, version=None):
+      # The file digest is a single native call over the whole buffer and the
+      # lines are hashed straight out of it.
+      self.version = version if version is not None else self._hasher.digest(buf)
+      self.lineHash = self._hasher.hashLines(buf)
+      callback = self.processLineCallback
+      if callback:
+         # same contract as _buildLines: called once per line, ending included
+         for line in _iterLines(buf):
+            callback(line)
+
+
+# Builds a single file, returning (filePath, version, lineHash), or None when
+# the file does not exist. This is a module level function so it can be
+# shipped to worker processes, which resolve the HashObject themselves from
+# the algorithm name.
+def _buildFile(filePath, previousVersion, hashAlgorithm, hasher=None):
+   fileObj = FileVersion(filePath, 
+                         hashAlgorithm=hashAlgorithm, 
+                         hasher=hasher)
+   try:
+      fileObj.build(previousVersion)
+   except OSError:
+      # Anything os.path.exists() reports as absent counts as missing (e.g. a
+      # path through a regular file or an over-long name); other errors stand.
+      if os.path.exists(filePath):
+         raise
+      return None
+   return fileObj.filePath, fileObj.version, fileObj.lineHash
 
 
 class VersionTable(object):
+   __slots__ = ('fileList', 'hashAlgorithm', '_hasher', 'jobs', 'fileVersions', 'version', 'hashObj', 'formatVersion')
 
-   def __init__(self, fileList, hashAlgorithm):
-      self.fileList = sorted(fileList)
+   def __init__(self, fileList, hashAlgorithm, jobs=1, hasher=None):
+      # kept sorted and duplicate free, VersionManager.compare relies on it
+      self.fileList = sorted(set(fileList))
       self.hashAlgorithm = hashAlgorithm
+      # the HashObject for hashAlgorithm; self.hashObj is the running table
+      # digest that build() creates from it
+      self._hasher = hasher
+      # number of worker processes used by build(), None for one per CPU
+      self.jobs = jobs
       self.fileVersions = None
       self.version = None
+      self.formatVersion = _FORMAT_VERSION
 
    def read(self, obj):
       self.hashAlgorithm = obj["hashAlgorithm"]
-      self.fileList = obj["fileList"]
+      self.fileList = sorted(set(obj["fileList"]))
       self.version = obj["version"]
+      self.formatVersion = obj.get("formatVersion", 1)
       self.fileVersions = {}
 
+      # Files that have since gone missing are kept; they simply have no
+      # counterpart in the built table.
       for filePath, normalizedObj in obj["files"].items():
-         if os.path.exists(filePath):
-            self.fileVersions[filePath] = FileVersion(normalizedObj["filePath"], 
-                                                      normalizedObj["version"], 
-                                                      normalizedObj["lineHash"], 
-                                                      self.hashAlgorithm)
-
-   def build(self):
-      self.hashObj = _HASHOBJ.new()
+         self.fileVersions[filePath] = FileVersion(normalizedObj["filePath"], 
+                                                   normalizedObj["version"], 
+                                                   normalizedObj["lineHash"], 
+                                                   self.hashAlgorithm)
+
+   # Switches the table to another algorithm. A table that was already built
+   # is rebuilt, since its digests are meaningless under the new algorithm;
+   # previous is passed on to build().
+   def setHashAlgorithm(self, hashAlgorithm, previous=None):
+      if hashAlgorithm == self.hashAlgorithm:
+         return
+      self.hashAlgorithm = hashAlgorithm
+      self._hasher = None
+      if self.version is not None:
+         self.build(previous)
+
+   # Given the table from the last run, files whose digest still matches reuse
+   # its line hashes instead of being hashed line by line.
+   def build(self, previous=None):
+      if self._hasher is None:
+         self._hasher = _getHashObject(self.hashAlgorithm)
+
+      previousFiles = {}
+      if previous is not None and previous.fileVersions and previous.hashAlgorithm == self.hashAlgorithm:
+         previousFiles = previous.fileVersions
+
+      self.hashObj = self._hasher.new()
       self.fileVersions = {}
-      for filePath in self.fileList:
-         if os.path.exists(filePath):
-            fileObj = FileVersion(filePath, 
-                                  hashAlgorithm=self.hashAlgorithm, 
-                                  processLineCallback=self._processLine)
-            fileObj.build()
-            self.fileVersions[filePath] = fileObj
-      self.version = self.hashObj.hexdigest()
+      # Missing files are detected by the open() in each build rather than a
+      # separate stat up front; they are left out of fileVersions.
+      previousVersions = [previousFiles[filePath].version if filePath in previousFiles else None 
+                          for filePath in self.fileList]
 
-   def _processLine(self, line):
-      self.hashObj.update(line)
+      if self.jobs == 1 or len(self.fileList) < 2:
+         results = map(partial(_buildFile, hashAlgorithm=self.hashAlgorithm, hasher=self._hasher), self.fileList, previousVersions)
+      else:
+         with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            results = list(executor.map(partial(_buildFile, hashAlgorithm=self.hashAlgorithm), self.fileList, previousVersions))
+
+      # results come back in fileList order, so the table version is stable
+      for result in results:
+         if result is None:
+            continue
+         filePath, version, lineHash = result
+         if filePath in previousFiles and previousFiles[filePath].version == version:
+            lineHash = previousFiles[filePath].lineHash
+         self.fileVersions[filePath] = FileVersion(filePath, version, lineHash, self.hashAlgorithm)
+         self.hashObj.update(version.encode('ascii'))
+      self.version = self.hashObj.hexdigest()
 
    def normalize(self):
       versionTables = {}
       for fileName, versionObj in self.fileVersions.items():
          versionTables[fileName] = versionObj.normalize()
 
-      return {"version": self.version, 
+      return {"formatVersion": self.formatVersion,
+              "version": self.version, 
               "hashAlgorithm": self.hashAlgorithm,
               "fileList": self.fileList,
               "files": versionTables}
 
 
+# Splits two sorted, duplicate free lists in a single pass into the items only
+# in the first, only in the second and in both, each still in sorted order.
+def _mergeSorted(first, second):
+   onlyFirst, onlySecond, both = [], [], []
+   i = j = 0
+   firstLen, secondLen = len(first), len(second)
+   while i < firstLen and j < secondLen:
+      a, b = first[i], second[j]
+      if a == b:
+         both.append(a)
+         i += 1
+         j += 1
+      elif a < b:
+         onlyFirst.append(a)
+         i += 1
+      else:
+         onlySecond.append(b)
+         j += 1
+   onlyFirst.extend(first[i:])
+   onlySecond.extend(second[j:])
+   return onlyFirst, onlySecond, both
+
+
+DiffFile = collections.namedtuple("DiffFile", "missing new modifiedLines missingLines")
+
 
 class VersionManager(object):
+   __slots__ = ('revisionFileName', 'curVersions', 'build', 'lastVersions', 'doWrite', 'diffs', 'followAlgorithm')
 
-   def __init__(self, revisionFileName, fileList, hashAlgorithm='md5', write=False):
-      global _HASHOBJ
-      _HASHOBJ = HashObject(hashAlgorithm)
+   def __init__(self, revisionFileName, fileList, hashAlgorithm=None, write=False, jobs=1):
+      # Without an explicit algorithm, an existing revision file's algorithm
+      # wins (see read()) so older revision files stay comparable.
+      self.followAlgorithm = hashAlgorithm is None
+      if hashAlgorithm is None:
+         hashAlgorithm = DEFAULT_ALGORITHM
+      hasher = _getHashObject(hashAlgorithm)
 
       self.revisionFileName = revisionFileName
-      self.curVersions = VersionTable(fileList, hashAlgorithm)
+      self.curVersions = VersionTable(fileList, hashAlgorithm, jobs, hasher)
       self.build = self.curVersions.build
       self.lastVersions = VersionTable([], hashAlgorithm)
       self.doWrite = write
@@ -164,39 +478,43 @@ class VersionManager(object):
       if not os.path.exists(self.revisionFileName):
          return {} 
 
-      with open(self.revisionFileName, 'r') as fh:
-         revisionInfo = json.load(fh)
+      with open(self.revisionFileName, 'rb') as fh:
+         if orjson:
+            revisionInfo = orjson.loads(fh.read())
+         else:
+            revisionInfo = json.load(fh)
 
       self.lastVersions.read(revisionInfo)
 
+      if self.followAlgorithm:
+         self.curVersions.setHashAlgorithm(self.lastVersions.hashAlgorithm, self.lastVersions)
+
    def write(self):
       if self.curVersions.version is None:
          self.curVersions.build()
 
       obj = self.curVersions.normalize()
-      with open(self.revisionFileName, 'w') as fh:
-         json.dump(obj, fh)
+      if orjson:
+         with open(self.revisionFileName, 'wb') as fh:
+            fh.write(orjson.dumps(obj))
+      else:
+         with open(self.revisionFileName, 'w') as fh:
+            json.dump(obj, fh)
 
    def compare(self):
-      if not all( (self.curVersions, self.lastVersions) ) :
+      if not all( (self.curVersions, self.lastVersions) ) or self.curVersions.fileVersions is None:
          raise RuntimeError("Must call read() and build() to compare versions.")
 
       if self.curVersions.hashAlgorithm != self.lastVersions.hashAlgorithm:
          raise RuntimeError("read() and build() hash algorithms differ.")
 
-      DiffFile = collections.namedtuple("DiffFile","missing new modifiedLines missingLines")
-
-      lastFileSet = set(self.lastVersions.fileList)
-      curFileSet = set(self.curVersions.fileList)
-      self.diffs = collections.OrderedDict()
+      self.diffs = {}
 
-      newFiles = curFileSet - lastFileSet
-      removedFiles = lastFileSet - curFileSet
-      overlappingFiles = curFileSet & lastFileSet
+      newFiles, removedFiles, overlappingFiles = _mergeSorted(self.curVersions.fileList, self.lastVersions.fileList)
 
       # Add new files
       for filePath in newFiles:
-         self.diffs[filePath] = DiffFile(missing=not os.path.exists(filePath), # it is possible for files listed in the fileList to not exist in the first place
+         self.diffs[filePath] = DiffFile(missing=filePath not in self.curVersions.fileVersions, # it is possible for files listed in the fileList to not exist in the first place
                                          new=True,
                                          modifiedLines=[],
                                          missingLines=[])
@@ -211,14 +529,8 @@ class VersionManager(object):
       # Check overlapping files for changes
       for filePath in overlappingFiles:
          try:
-            try:
-               # python 2 dictionary views are explicit
-               lastLines = self.lastVersions.fileVersions[filePath].lineHash.viewkeys() 
-               curLines = self.curVersions.fileVersions[filePath].lineHash.viewkeys()
-            except AttributeError:
-               # python 3 dictinoary views are by default
-               lastLines = self.lastVersions.fileVersions[filePath].lineHash.keys()
-               curLines = self.curVersions.fileVersions[filePath].lineHash.keys()
+            lastFileObj = self.lastVersions.fileVersions[filePath]
+            curFileObj = self.curVersions.fileVersions[filePath]
          except KeyError:
             self.diffs[filePath] = DiffFile(missing=True,
                                             new=True,
@@ -226,20 +538,25 @@ class VersionManager(object):
                                             missingLines=[])
             continue
 
-         modifiedLines = sorted(list(curLines - lastLines))
-         missingLines = sorted(list(lastLines - curLines))
-
-         curLineTbl = self.curVersions.fileVersions[filePath].lineHash
-         lastLineTbl = self.lastVersions.fileVersions[filePath].lineHash
+         if curFileObj.version == lastFileObj.version:
+            # same file digest, no need to walk the line hashes
+            self.diffs[filePath] = DiffFile(missing=False,
+                                            new=False,
+                                            modifiedLines=[],
+                                            missingLines=[])
+            continue
 
+         lastLineTbl = lastFileObj.lineHash
+         curLineTbl = curFileObj.lineHash
+         # the hashes themselves are opaque, only the line numbers are sorted
          self.diffs[filePath] = DiffFile(missing=False,
                                          new=False,
-                                         modifiedLines=[curLineTbl[hsh] for hsh in modifiedLines],
-                                         missingLines=[lastLineTbl[hsh] for hsh in missingLines])
+                                         modifiedLines=sorted(curLineTbl[hsh] for hsh in curLineTbl.keys() - lastLineTbl.keys()),
+                                         missingLines=sorted(lastLineTbl[hsh] for hsh in lastLineTbl.keys() - curLineTbl.keys()))
 
    def __enter__(self):
       self.read()
-      self.build()
+      self.build(self.lastVersions)
       self.compare()
       return self
 
@@ -248,6 +565,13 @@ class VersionManager(object):
          self.write()
 
    def hasVersionChanged(self):
+      if self.lastVersions.formatVersion != self.curVersions.formatVersion:
+         # the table version of an older revision file was computed another
+         # way, so decide from the set of files and their digests instead
+         lastFiles = self.lastVersions.fileVersions or {}
+         curFiles = self.curVersions.fileVersions or {}
+         return lastFiles.keys() != curFiles.keys() or \
+                any(fileObj.version != lastFiles[filePath].version for filePath, fileObj in curFiles.items())
       return self.curVersions.version != self.lastVersions.version
 
    def getVersion(self):